@@ -4,8 +4,9 @@ __author__ = """Ben Thomasson"""
 __email__ = 'benthomasson@gmail.com'
 __version__ = '0.1.2'
 
-from .module import run_module, run_ftl_module
-from .ssh import close_gate
-from .inventory import load_inventory
+from .module import run_module, run_modules, run_ftl_module
+from .ssh import close_gate, clean_up_gates
+from .inventory import load_inventory, load_localhost
+from .types import GateCache
 
-__all__ = ['run_module', 'run_ftl_module', 'load_inventory', 'close_gate']
+__all__ = ['run_module', 'run_modules', 'run_ftl_module', 'load_inventory', 'load_localhost', 'close_gate', 'clean_up_gates', 'GateCache']
@@ -10,16 +10,19 @@ Options:
     -i=<i>, --inventory=<i>     Inventory
     -r=<r>, --requirements      Python requirements
     -a=<a>, --args=<a>          Module arguments
+    -c=<c>, --concurrency=<c>   Number of hosts to run at once [default: 10]
     --debug                     Show debug logging
     --verbose                   Show verbose logging
 """
-import asyncio
-from docopt import docopt
+from docopt import docopt, DocoptExit
 import logging
 import sys
 from .module import run_module
 from .module import run_ftl_module
 from .inventory import load_inventory
+from .util import run_fast_loop
+from .ssh import clean_up_gates
+from .types import GateCache
 from pprint import pprint
 
 from typing import Optional, List, Dict
@@ -47,30 +50,48 @@ async def main(args: Optional[List[str]] = None) -> int:
     else:
         logging.basicConfig(level=logging.WARNING)
 
+    try:
+        concurrency = int(parsed_args["--concurrency"])
+    except ValueError:
+        concurrency = 0
+    if concurrency < 1:
+        raise DocoptExit("--concurrency must be a positive integer")
+
     dependencies = None
     if parsed_args["--requirements"]:
         with open(parsed_args["--requirements"]) as f:
             dependencies = [x for x in f.read().splitlines() if x]
 
-    if parsed_args["--module"]:
-        output = await run_module(
-            load_inventory(parsed_args["--inventory"]),
-            [parsed_args["--module-dir"]],
-            parsed_args["--module"],
-            modules=[parsed_args["--module"]],
-            module_args=parse_module_args(parsed_args["--args"]),
-            dependencies=dependencies,
-        )
-        pprint(output)
-    elif parsed_args["--ftl-module"]:
-        output = await run_ftl_module(
-            load_inventory(parsed_args["--inventory"]),
-            [parsed_args["--module-dir"]],
-            parsed_args["--ftl-module"],
-        )
-        pprint(output)
+    # Gates are kept open for the run so that each host only receives the
+    # gate once, and clean_up_gates shuts them down at the end.  The cache is
+    # bounded to stay well below the open file limit on large inventories.
+    gate_cache = GateCache(max_gates=256)
+    try:
+        if parsed_args["--module"]:
+            output = await run_module(
+                load_inventory(parsed_args["--inventory"]),
+                [parsed_args["--module-dir"]],
+                parsed_args["--module"],
+                gate_cache=gate_cache,
+                modules=[parsed_args["--module"]],
+                module_args=parse_module_args(parsed_args["--args"]),
+                dependencies=dependencies,
+                concurrency=concurrency,
+            )
+            pprint(output)
+        elif parsed_args["--ftl-module"]:
+            output = await run_ftl_module(
+                load_inventory(parsed_args["--inventory"]),
+                [parsed_args["--module-dir"]],
+                parsed_args["--ftl-module"],
+                gate_cache=gate_cache,
+                concurrency=concurrency,
+            )
+            pprint(output)
+    finally:
+        await clean_up_gates(gate_cache)
     return 0
 
 
 def entry_point() -> None:
-    asyncio.run(main(sys.argv[1:]))   # pragma: no cover
+    run_fast_loop(main(sys.argv[1:]))   # pragma: no cover
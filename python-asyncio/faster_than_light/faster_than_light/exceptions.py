@@ -2,3 +2,7 @@
 
 class ModuleNotFound(Exception):
     pass
+
+
+class GateStartFailed(Exception):
+    pass
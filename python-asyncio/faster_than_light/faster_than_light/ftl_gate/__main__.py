@@ -12,17 +12,53 @@ import logging
 import traceback
 import stat
 
+from typing import Any, Callable, Optional, Union
+
+try:
+    # orjson is used when it is bundled as a gate dependency
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    # The fallbacks match the orjson signatures.
+    def json_dumps(
+        __obj: Any,
+        default: Optional[Callable[[Any], Any]] = None,
+        option: Optional[int] = None,
+    ) -> bytes:
+        return json.dumps(__obj, default=default).encode()
+
+    def json_loads(__obj: Union[bytes, bytearray, memoryview, str]) -> Any:
+        if isinstance(__obj, memoryview):
+            __obj = bytes(__obj)
+        return json.loads(__obj)
+
 logger = logging.getLogger('ftl_gate')
 
 
+def read_stdin(n):
+
+    # Frames and payloads are both read from the binary buffer so that the
+    # text layer cannot read ahead into a payload.
+    data = b''
+    while len(data) < n:
+        chunk = sys.stdin.buffer.read(n - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
 class StdinReader(object):
 
     async def read(self, n):
         loop = asyncio.get_running_loop()
-        result = await loop.run_in_executor(None, sys.stdin.read, n)
-        if isinstance(result, str):
-            result = result.encode()
-        return result
+        return await loop.run_in_executor(None, read_stdin, n)
+
+    async def readexactly(self, n):
+        loop = asyncio.get_running_loop()
+        data = await loop.run_in_executor(None, read_stdin, n)
+        if len(data) < n:
+            raise asyncio.IncompleteReadError(data, n)
+        return data
 
 
 class StdoutWriter(object):
@@ -88,7 +124,7 @@ async def read_message(reader):
                 # System will exit
                 if value:
                     try:
-                        return json.loads(value)
+                        return json_loads(value)
                     except BaseException:
                         print(value)
                         raise
@@ -96,6 +132,16 @@ async def read_message(reader):
                     continue
 
 
+async def read_payload(reader, data):
+
+    # Messages with a payload_size are followed by that many bytes
+    # of raw module data.
+    payload_size = data.pop('payload_size', None)
+    if payload_size is not None:
+        data['module'] = await reader.readexactly(payload_size)
+    return data
+
+
 def send_message(writer, msg_type, data):
 
     # A message has a Length[Type, Data] format.
@@ -104,15 +150,15 @@ def send_message(writer, msg_type, data):
     # The JSON encoded data is a pair where the first
     # item is the message type and the second
     # item is the data.
-    message = json.dumps([msg_type, data]).encode()
+    message = json_dumps([msg_type, data])
     assert len(message) < 16**8, f'Message {msg_type} is too big.  Break up messages into less than 16**8 bytes'
-    writer.write('{:08x}'.format(len(message)).encode())
-    writer.write(message)
+    writer.write(b'%08x%s' % (len(message), message))
 
 
-async def check_output(cmd, env=None, stdin=None):
-    proc = await asyncio.create_subprocess_shell(
-        cmd,
+async def check_output(*cmd, env=None, stdin=None):
+    # Run the module directly instead of through a shell
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
         stdin=asyncio.subprocess.PIPE,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
@@ -155,7 +201,8 @@ async def gate_run_module(writer, module_name, module=None, module_args=None):
         module_file = os.path.join(tempdir, module_name)
         if module is not None:
             logger.info("loading module from message")
-            module = base64.b64decode(module)
+            if isinstance(module, str):
+                module = base64.b64decode(module)
             with open(module_file, 'wb') as f:
                 f.write(module)
         else:
@@ -170,10 +217,10 @@ async def gate_run_module(writer, module_name, module=None, module_args=None):
             with open(args, 'w') as f:
                 f.write(json.dumps(module_args))
             os.chmod(module_file, stat.S_IEXEC | stat.S_IREAD)
-            stdout, stderr = await check_output(f'{module_file} {args}')
+            stdout, stderr = await check_output(module_file, args)
         elif is_new_style_module(module):
             logger.info("is_new_style_module")
-            stdout, stderr = await check_output(f'{sys.executable} {module_file}',
+            stdout, stderr = await check_output(sys.executable, module_file,
                                                 stdin=json.dumps(dict(ANSIBLE_MODULE_ARGS=module_args)).encode(),
                                                 env=dict(PYTHONPATH=get_python_path()))
         elif is_want_json_module(module):
@@ -181,7 +228,7 @@ async def gate_run_module(writer, module_name, module=None, module_args=None):
             args = os.path.join(tempdir, 'args')
             with open(args, 'w') as f:
                 f.write(json.dumps(module_args))
-            stdout, stderr = await check_output(f'{sys.executable} {module_file} {args}',
+            stdout, stderr = await check_output(sys.executable, module_file, args,
                                                 env=dict(PYTHONPATH=get_python_path()))
         else:
             logger.info("is_old_style_module")
@@ -191,7 +238,7 @@ async def gate_run_module(writer, module_name, module=None, module_args=None):
                     f.write(" ".join(["=".join([k, v]) for k, v in module_args.items()]))
                 else:
                     f.write('')
-            stdout, stderr = await check_output(f'{sys.executable} {module_file} {args}',
+            stdout, stderr = await check_output(sys.executable, module_file, args,
                                                 env=dict(PYTHONPATH=get_python_path()))
         logger.info("Sending ModuleResult")
         send_message(writer, 'ModuleResult', dict(stdout=stdout.decode(),
@@ -203,7 +250,9 @@ async def gate_run_module(writer, module_name, module=None, module_args=None):
 
 async def run_ftl_module(writer, module_name, module, module_args=None):
 
-    module_compiled = compile(base64.b64decode(module), module_name, 'exec')
+    if isinstance(module, str):
+        module = base64.b64decode(module)
+    module_compiled = compile(module, module_name, 'exec')
 
     globals = {'__file__': module_name}
     locals = {}
@@ -238,10 +287,10 @@ async def main(args):
                 send_message(writer, msg_type, data)
             elif msg_type == 'Module':
                 logger.info('Module')
-                await gate_run_module(writer, **data)
+                await gate_run_module(writer, **(await read_payload(reader, data)))
             elif msg_type == 'FTLModule':
                 logger.info('FTLModule')
-                await run_ftl_module(writer, **data)
+                await run_ftl_module(writer, **(await read_payload(reader, data)))
             elif msg_type == 'Shutdown':
                 logger.info('Shutdown')
                 send_message(writer, 'Goodbye', {})
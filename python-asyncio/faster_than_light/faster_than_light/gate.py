@@ -1,4 +1,5 @@
 import hashlib
+import logging
 import os
 import sys
 import shutil
@@ -12,7 +13,13 @@ from subprocess import check_output
 from .util import ensure_directory, read_module, find_module
 from .exceptions import ModuleNotFound
 
-from typing import Optional, List
+from typing import Optional, List, Dict, Tuple
+
+logger = logging.getLogger("faster_than_light.gate")
+
+
+# Gates built by this process keyed by the arguments of build_ftl_gate
+_gates: Dict[Tuple[Tuple[str, ...], Tuple[str, ...], Tuple[str, ...], str], str] = {}
 
 
 def build_ftl_gate(
@@ -22,8 +29,6 @@ def build_ftl_gate(
     interpreter: str = sys.executable,
 ) -> str:
 
-    cache = ensure_directory("~/.ftl")
-
     if modules is None:
         modules = []
     if module_dirs is None:
@@ -31,7 +36,17 @@ def build_ftl_gate(
     if dependencies is None:
         dependencies = []
 
-    inputs = []
+    # Return a gate built earlier in this process without reading and
+    # hashing the gate source again.
+    key = (tuple(modules), tuple(module_dirs), tuple(dependencies), interpreter)
+    if key in _gates and os.path.exists(_gates[key]):
+        return _gates[key]
+
+    cache = ensure_directory("~/.ftl")
+
+    gate_main = files(faster_than_light.ftl_gate).joinpath("__main__.py").read_text()
+
+    inputs = [gate_main]
     inputs.extend(modules)
     inputs.extend(module_dirs)
     inputs.extend(dependencies)
@@ -41,12 +56,13 @@ def build_ftl_gate(
 
     cached_gate = os.path.join(cache, f"ftl_gate_{gate_hash}.pyz")
     if os.path.exists(cached_gate):
+        _gates[key] = cached_gate
         return cached_gate
 
     tempdir = tempfile.mkdtemp()
     os.mkdir(os.path.join(tempdir, "ftl_gate"))
     with open(os.path.join(tempdir, "ftl_gate", "__main__.py"), "w") as f:
-        f.write(files(faster_than_light.ftl_gate).joinpath("__main__.py").read_text())
+        f.write(gate_main)
 
     module_dir = os.path.join(tempdir, "ftl_gate", "ftl_gate")
     os.makedirs(module_dir)
@@ -80,14 +96,15 @@ def build_ftl_gate(
                 os.path.join(tempdir, "ftl_gate"),
             ]
         )
-        print(output)
+        logger.info("%s", output.decode())
 
     zipapp.create_archive(
         os.path.join(tempdir, "ftl_gate"),
         os.path.join(tempdir, "ftl_gate.pyz"),
         interpreter,
     )
-    shutil.rmtree(os.path.join(tempdir, "ftl_gate"))
     shutil.copy(os.path.join(tempdir, "ftl_gate.pyz"), cached_gate)
+    shutil.rmtree(tempdir)
 
+    _gates[key] = cached_gate
     return cached_gate
@@ -1,11 +1,57 @@
 
-import yaml
+import copy
+import os
+import sys
 
-from typing import Any
+from functools import lru_cache
+from typing import Any, Dict
+
+
+@lru_cache(maxsize=32)
+def _load_inventory(inventory_file: str, mtime: int, size: int, inode: int) -> Any:
+
+    # yaml is imported lazily so that load_localhost does not pay for it
+    import yaml
+
+    try:
+        from yaml import CSafeLoader as SafeLoader
+    except ImportError:
+        from yaml import SafeLoader  # type: ignore
+
+    with open(inventory_file, "rb") as f:
+        return yaml.load(f, Loader=SafeLoader)
 
 
 def load_inventory(inventory_file: str) -> Any:
 
-    with open(inventory_file) as f:
-        inventory_data = yaml.safe_load(f.read())
-    return inventory_data
+    """
+    Loads an inventory file.
+
+    Parsed inventories are cached until the file is modified or replaced.
+    Each call returns a copy so callers may change it.
+    """
+
+    st = os.stat(inventory_file)
+    return copy.deepcopy(
+        _load_inventory(
+            os.path.abspath(inventory_file), st.st_mtime_ns, st.st_size, st.st_ino
+        )
+    )
+
+
+def load_localhost(interpreter: str = sys.executable) -> Dict:
+
+    """
+    Returns an inventory containing only localhost with a local connection.
+    """
+
+    return {
+        "all": {
+            "hosts": {
+                "localhost": {
+                    "ansible_connection": "local",
+                    "ansible_python_interpreter": interpreter,
+                }
+            }
+        }
+    }
@@ -1,102 +1,170 @@
 import asyncio
+import atexit
 import json
+import logging
 import os
+import shlex
 import shutil
+import subprocess
 import tempfile
 import sys
 
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import count
 from typing import Dict, Tuple
 
+from .util import read_module_bytes, classify_module
+from .message import module_json_loads
 
-async def check_output(cmd: str, stdin=None) -> bytes:
-    proc = await asyncio.create_subprocess_shell(
+logger = logging.getLogger("faster_than_light.local")
+
+
+# Starting a process blocks until the child has exec'd so processes are
+# started in threads to keep the event loop running during fan out.
+_spawn_executor = ThreadPoolExecutor(max_workers=8)
+
+
+def spawn(cmd: Tuple[str, ...]) -> subprocess.Popen:
+    return subprocess.Popen(
         cmd,
-        stdin=asyncio.subprocess.PIPE,
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.STDOUT,
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
     )
 
-    stdout, stderr = await proc.communicate(stdin)
+
+async def check_output(*cmd: str, stdin=None) -> bytes:
+    loop = asyncio.get_running_loop()
+    # Run the command directly instead of through a shell.
+    try:
+        proc = await loop.run_in_executor(_spawn_executor, spawn, cmd)
+    except OSError as e:
+        # Report commands that cannot be run in the output like a shell would.
+        return f"{cmd[0]}: {e.strerror}".encode()
+    # spawn always opens stdin and stdout as pipes.
+    assert proc.stdin is not None and proc.stdout is not None
+
+    # stderr is merged into stdout so there is only one pipe to read.
+    reader = asyncio.StreamReader()
+    read_transport, _ = await loop.connect_read_pipe(
+        lambda: asyncio.StreamReaderProtocol(reader), proc.stdout
+    )
+    if stdin:
+        write_transport, _ = await loop.connect_write_pipe(asyncio.Protocol, proc.stdin)
+        write_transport.write(stdin)
+        write_transport.close()
+    else:
+        proc.stdin.close()
+    try:
+        stdout = await reader.read()
+    finally:
+        read_transport.close()
+    # The child has closed its output so it has exited or is about to.
+    await loop.run_in_executor(None, proc.wait)
     return stdout
 
 
-def is_binary_module(module: str) -> bool:
-    try:
-        with open(module) as f:
-            for line in f.readlines():
-                pass
-        return False
-    except UnicodeDecodeError:
-        return True
+# Names the args files of concurrent runs that share a staged module
+_args_counter = count()
+
+# Staged copies of modules keyed by module path and modification time
+_staged_modules: Dict[Tuple[str, int], str] = {}
+
 
+def stage_module(module: str) -> str:
 
-def is_new_style_module(module: str) -> bool:
-    with open(module) as f:
-        for line in f.readlines():
-            if "AnsibleModule(" in line:
-                return True
+    """
+    Places a module in a temporary directory once so that every local host
+    can run the same copy.
+    """
 
-    return False
+    key = (module, os.stat(module).st_mtime_ns)
+    staged = _staged_modules.get(key)
+    if staged is None or not os.path.exists(staged):
+        # Remove copies of older versions of the module.
+        for old_key in [k for k in _staged_modules if k[0] == module]:
+            remove_staged_module(_staged_modules.pop(old_key))
+        tmp = tempfile.mkdtemp(prefix="ftl-")
+        staged = os.path.join(tmp, "module.py")
+        try:
+            os.link(module, staged)
+        except OSError:
+            shutil.copy(module, staged)
+        _staged_modules[key] = staged
+    return staged
 
 
-def is_want_json_module(module: str) -> bool:
-    with open(module) as f:
-        for line in f.readlines():
-            if "WANT_JSON" in line:
-                return True
+def remove_staged_module(staged: str) -> None:
+    shutil.rmtree(os.path.dirname(staged), ignore_errors=True)
 
-    return False
+
+@atexit.register
+def remove_staged_modules() -> None:
+    while _staged_modules:
+        _, staged = _staged_modules.popitem()
+        remove_staged_module(staged)
 
 
 async def run_module_locally(
     host_name: str, host: Dict, module: str, module_args: Dict
 ) -> Tuple[str, Dict]:
-    tmp = tempfile.mkdtemp()
-    tmp_module = os.path.join(tmp, "module.py")
-    shutil.copy(module, tmp_module)
+    tmp_module = stage_module(module)
+    args = os.path.join(os.path.dirname(tmp_module), f"args-{next(_args_counter)}")
     # TODO: replace hashbang with ansible_python_interpreter
     # TODO: add utf-8 encoding line
-    interpreter = host.get("ansible_python_interpreter", sys.executable)
-    if is_binary_module(module):
-        args = os.path.join(tmp, "args")
-        with open(args, "w") as f:
-            f.write(json.dumps(module_args))
-        output = await check_output(f"{tmp_module} {args}")
-    elif is_new_style_module(module):
-        output = await check_output(
-            f"{interpreter} {tmp_module}",
-            stdin=json.dumps(dict(ANSIBLE_MODULE_ARGS=module_args)).encode(),
-        )
-    elif is_want_json_module(module):
-        args = os.path.join(tmp, "args")
-        with open(args, "w") as f:
-            f.write(json.dumps(module_args))
-        output = await check_output(f"{interpreter} {tmp_module} {args}")
-    else:
-        args = os.path.join(tmp, "args")
-        with open(args, "w") as f:
-            if module_args is not None:
-                f.write(" ".join(["=".join([k, v]) for k, v in module_args.items()]))
-            else:
-                f.write("")
-        output = await check_output(f"{interpreter} {tmp_module} {args}")
+    interpreter = shlex.split(host.get("ansible_python_interpreter", sys.executable))
+    try:
+        is_binary, is_new_style, is_want_json = classify_module(module)
+        if is_binary:
+            with open(args, "w") as f:
+                f.write(json.dumps(module_args))
+            output = await check_output(tmp_module, args)
+        elif is_new_style:
+            output = await check_output(
+                *interpreter,
+                tmp_module,
+                stdin=json.dumps(dict(ANSIBLE_MODULE_ARGS=module_args)).encode(),
+            )
+        elif is_want_json:
+            with open(args, "w") as f:
+                f.write(json.dumps(module_args))
+            output = await check_output(*interpreter, tmp_module, args)
+        else:
+            with open(args, "w") as f:
+                if module_args is not None:
+                    f.write(" ".join(["=".join([k, v]) for k, v in module_args.items()]))
+                else:
+                    f.write("")
+            output = await check_output(*interpreter, tmp_module, args)
+    finally:
+        if os.path.exists(args):
+            os.unlink(args)
     try:
-        return host_name, json.loads(output)
+        return host_name, module_json_loads(output)
     except Exception:
-        print(output)
+        logger.debug("module output is not JSON: %s", output)
         return host_name, dict(error=output)
 
 
-async def run_ftl_module_locally(
-    host_name: str, host: Dict, module_path: str, module_args: Dict
-) -> Tuple[str, dict]:
+@lru_cache(maxsize=64)
+def _load_ftl_module(module_path: str, mtime: int) -> Dict:
 
-    with open(module_path, "rb") as f:
-        module_compiled = compile(f.read(), module_path, "exec")
+    module_compiled = compile(read_module_bytes(module_path), module_path, "exec")
 
     globals = {"__file__": module_path}
     locals: Dict = {}
 
     exec(module_compiled, globals, locals)
+    return locals
+
+
+async def run_ftl_module_locally(
+    host_name: str, host: Dict, module_path: str, module_args: Dict
+) -> Tuple[str, dict]:
+
+    # The module is compiled and executed once until it is modified
+    # and then only main is called for each host.
+    locals = _load_ftl_module(module_path, os.stat(module_path).st_mtime_ns)
     result = await locals["main"]()
     return host_name, result
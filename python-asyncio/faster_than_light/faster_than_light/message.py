@@ -1,6 +1,34 @@
 
+import asyncio
 import json
-from typing import NamedTuple, Any
+from typing import NamedTuple, Any, Callable, Optional, Union
+
+try:
+    # orjson is faster and produces bytes directly
+    from orjson import dumps as json_dumps, loads as json_loads
+except ImportError:
+    # The fallbacks match the orjson signatures.
+    def json_dumps(
+        __obj: Any,
+        default: Optional[Callable[[Any], Any]] = None,
+        option: Optional[int] = None,
+    ) -> bytes:
+        return json.dumps(__obj, default=default).encode()
+
+    def json_loads(__obj: Union[bytes, bytearray, memoryview, str]) -> Any:
+        if isinstance(__obj, memoryview):
+            __obj = bytes(__obj)
+        return json.loads(__obj)
+
+
+def module_json_loads(data: Union[bytes, str]) -> Any:
+    # Module output is not limited to strict JSON. orjson rejects NaN and
+    # Infinity so fall back to the json module for those.
+    try:
+        return json_loads(data)
+    except ValueError:
+        return json.loads(data)
+
 
 class GateMessage(NamedTuple):
     message_type: str
@@ -8,25 +36,34 @@ class GateMessage(NamedTuple):
 
 
 def send_message(writer, msg_type, msg_data):
-    message = json.dumps([msg_type, msg_data]).encode()
+    message = json_dumps([msg_type, msg_data])
     #print('{:08x}'.format(len(message)).encode())
     #print(message)
-    writer.write('{:08x}'.format(len(message)).encode())
-    writer.write(message)
+    # One write per frame lets the transport send the length and the
+    # message together.
+    writer.write(b'%08x%s' % (len(message), message))
+
+
+def send_message_with_payload(writer, msg_type, msg_data, payload):
+    # The payload is written as raw bytes directly after the message
+    # so that binary data does not need to be encoded into JSON.
+    send_message(writer, msg_type, dict(msg_data, payload_size=len(payload)))
+    writer.write(payload)
 
 
 def send_message_str(writer, msg_type, msg_data):
     message = json.dumps([msg_type, msg_data])
     #print('{:08x}'.format(len(message)))
     #print(message)
-    writer.write('{:08x}'.format(len(message)))
-    writer.write(message)
+    writer.write('{:08x}{}'.format(len(message), message))
 
 
 async def read_message(reader):
-    while True:
-        length = await reader.read(8)
-        if not length:
-            return None
-        value = await reader.read(int(length, 16))
-        return json.loads(value)
+    # read() may return less than requested so both the length and the
+    # value are read with readexactly.
+    try:
+        length = await reader.readexactly(8)
+        value = await reader.readexactly(int(length, 16))
+    except asyncio.IncompleteReadError:
+        return None
+    return json_loads(value)
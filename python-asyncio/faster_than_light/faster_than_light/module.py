@@ -1,35 +1,36 @@
 import asyncio
-from functools import partial
+import os
 
 from .gate import build_ftl_gate
-from .util import chunk, find_module
-from .types import Gate
-from .ssh import run_module_through_gate, run_ftl_module_through_gate, run_module_remotely
+from .util import find_module, read_module_bytes
+from .types import Gate, GateKey
+from .ssh import run_module_through_gate, run_modules_through_gate, run_ftl_module_through_gate, run_module_remotely, run_remotely, get_interpreter
 from .local import run_module_locally, run_ftl_module_locally
 from .exceptions import ModuleNotFound
 
-from typing import Dict, Optional, Callable, List, Tuple
-from asyncio.tasks import Task
+from asyncssh.process import SSHClientProcess
 
+from typing import Any, Dict, Optional, Callable, List, Tuple, cast
 
-def unique_hosts(inventory: Dict) -> Dict:
 
-    hosts = {}
+def unique_hosts(inventory: Dict) -> Dict:
 
-    for group_name, group in inventory.items():
-        for host_name, host in group.get("hosts").items():
-            hosts[host_name] = host
+    """
+    Returns the hosts of all groups in an inventory.
+    """
 
+    # dict.update merges each group in C instead of iterating in Python.
+    hosts: Dict = {}
+    for group in inventory.values():
+        group_hosts = group.get("hosts")
+        if group_hosts:
+            hosts.update(group_hosts)
     return hosts
 
 
-def extract_task_results(tasks: List[Task]) -> Dict[str, Dict]:
+def is_local(host: Optional[Dict]) -> bool:
 
-    results = {}
-    for task in tasks:
-        host_name, result = task.result()
-        results[host_name] = result
-    return results
+    return bool(host and host.get("ansible_connection") == "local")
 
 
 async def run_module_on_host(
@@ -39,13 +40,90 @@ async def run_module_on_host(
     module_args: Dict,
     local_runner: Callable,
     remote_runner: Callable,
-    gate_cache: Optional[Dict[str, Gate]],
-    gate_builder: Callable,
+    gate_cache: Optional[Dict[GateKey, Gate]],
+    gates: Dict[str, str],
 ) -> Tuple[str, Dict]:
-    if host and host.get("ansible_connection") == "local":
+    if is_local(host):
         return await local_runner(host_name, host, module, module_args)
     else:
-        return await run_module_remotely(host_name, host, module, module_args, remote_runner, gate_cache, gate_builder)
+        return await run_module_remotely(host_name, host, module, module_args, remote_runner, gate_cache, gates)
+
+
+async def _find_modules(module_dirs: List[str], module_names: List[str]) -> List[str]:
+
+    """
+    Returns the paths of modules and reads them into the module cache.
+    """
+
+    found = []
+    for module_name in module_names:
+        module = find_module(module_dirs, module_name)
+        if module is None:
+            raise ModuleNotFound(f"Module {module_name} not found in {module_dirs}")
+        found.append(module)
+
+    # Read the modules once in a thread so that the per-host sends are served
+    # from the read_module_bytes cache without blocking the event loop.
+    loop = asyncio.get_running_loop()
+    for module in found:
+        await loop.run_in_executor(None, read_module_bytes, module)
+
+    return found
+
+
+def _build_gates(
+    hosts: Dict,
+    module_dirs: List[str],
+    modules: List[str],
+    dependencies: Optional[List[str]],
+) -> Dict[str, str]:
+
+    # Build one gate per distinct interpreter instead of once per remote host.
+    return {
+        interpreter: build_ftl_gate(
+            modules=modules,
+            module_dirs=module_dirs,
+            dependencies=dependencies,
+            interpreter=interpreter,
+        )
+        for interpreter in {
+            get_interpreter(host) for host in hosts.values() if not is_local(host)
+        }
+    }
+
+
+async def _run_on_hosts(
+    hosts: Dict, run_on_host: Callable, concurrency: int
+) -> Dict[str, Any]:
+
+    # Limit the number of hosts in flight to reduce contention for remote connections.
+    # A semaphore starts the next host as soon as any host finishes instead of
+    # waiting for the slowest host in a fixed chunk.
+    semaphore = asyncio.Semaphore(concurrency)
+
+    # Results are written by each host task as it finishes.  Preallocating the
+    # keys keeps the results in inventory order.  Every host task stores a
+    # result or an error so no value is left as None.
+    results = cast(Dict[str, Any], dict.fromkeys(hosts))
+
+    async def run_on_host_limited(host_name: str, host: Dict) -> None:
+        async with semaphore:
+            try:
+                _, results[host_name] = await run_on_host(host_name, host)
+            except Exception as e:
+                # One failed host should not lose the results of the others.
+                results[host_name] = {
+                    "error": {"error_type": type(e).__name__, "message": str(e)}
+                }
+
+    await asyncio.gather(
+        *[
+            run_on_host_limited(host_name, host)
+            for host_name, host in hosts.items()
+        ]
+    )
+
+    return results
 
 
 async def _run_module(
@@ -54,68 +132,55 @@ async def _run_module(
     module_name: str,
     local_runner: Callable,
     remote_runner: Callable,
-    gate_cache: Optional[Dict[str, Gate]],
+    gate_cache: Optional[Dict[GateKey, Gate]],
     modules: Optional[List[str]],
     dependencies: Optional[List[str]],
     module_args: Optional[Dict],
+    concurrency: int = 10,
 ) -> Dict[str, Dict]:
 
-    module = find_module(module_dirs, module_name)
+    if concurrency < 1:
+        raise ValueError(f"concurrency must be at least 1, not {concurrency}")
 
     if modules is None:
         modules = []
     if module_name not in modules:
         modules.append(module_name)
 
-    if module is None:
-        raise ModuleNotFound(f"Module {module_name} not found in {module_dirs}")
+    module, = await _find_modules(module_dirs, [module_name])
 
     hosts = unique_hosts(inventory)
+    gates = _build_gates(hosts, module_dirs, modules, dependencies)
 
-    gate_builder: Callable[[str], str] = partial(
-        build_ftl_gate,
-        modules=modules,
-        module_dirs=module_dirs,
-        dependencies=dependencies,
-    )
+    async def run_on_host(host_name: str, host: Dict) -> Tuple[str, Dict]:
+        return await run_module_on_host(
+            host_name,
+            host,
+            module,
+            module_args,
+            local_runner,
+            remote_runner,
+            gate_cache,
+            gates,
+        )
 
-    all_tasks = []
-    # Run the tasks in chunks of 10 to reduce contention for remote connections.
-    # This doubles performance at num_hosts=1000 for remote execution
-    for c in chunk(list(hosts.items()), 10):
-        tasks = []
-        for host_name, host in c:
-            tasks.append(
-                asyncio.create_task(
-                    run_module_on_host(
-                        host_name,
-                        host,
-                        module,
-                        module_args,
-                        local_runner,
-                        remote_runner,
-                        gate_cache,
-                        gate_builder,
-                    )
-                )
-            )
-        await asyncio.gather(*tasks)
-        all_tasks.extend(tasks)
-
-    return extract_task_results(all_tasks)
+    return await _run_on_hosts(hosts, run_on_host, concurrency)
 
 
 async def run_module(
     inventory: Dict,
     module_dirs: List[str],
     module_name: str,
-    gate_cache: Optional[Dict[str, Gate]] = None,
+    gate_cache: Optional[Dict[GateKey, Gate]] = None,
     modules: Optional[List[str]] = None,
     dependencies: Optional[List[str]] = None,
     module_args: Optional[Dict] = None,
+    concurrency: int = 10,
 ) -> Dict[str, Dict]:
     """
     Runs a module on all items in an inventory concurrently.
+
+    At most concurrency hosts are run at the same time.
     """
 
     return await _run_module(
@@ -128,6 +193,7 @@ async def run_module(
         modules,
         dependencies,
         module_args,
+        concurrency,
     )
 
 
@@ -135,13 +201,16 @@ async def run_ftl_module(
     inventory: Dict,
     module_dirs: List[str],
     module_name: str,
-    gate_cache: Optional[Dict[str, Gate]] = None,
+    gate_cache: Optional[Dict[GateKey, Gate]] = None,
     modules: Optional[List[str]] = None,
     dependencies: Optional[List[str]] = None,
     module_args: Optional[Dict] = None,
+    concurrency: int = 10,
 ) -> Dict[str, Dict]:
     """
     Runs a module on all items in an inventory concurrently.
+
+    At most concurrency hosts are run at the same time.
     """
 
     return await _run_module(
@@ -154,4 +223,51 @@ async def run_ftl_module(
         modules,
         dependencies,
         module_args,
+        concurrency,
     )
+
+
+async def run_modules(
+    inventory: Dict,
+    module_dirs: List[str],
+    module_calls: List[Tuple[str, Dict]],
+    gate_cache: Optional[Dict[GateKey, Gate]] = None,
+    dependencies: Optional[List[str]] = None,
+    concurrency: int = 10,
+) -> Dict[str, List[Dict]]:
+    """
+    Runs several modules in order on all items in an inventory concurrently.
+
+    module_calls is a list of module names and module arguments. The
+    modules for a remote host are pipelined through one gate so each host
+    waits one round trip instead of one per module. The results for each
+    host are in the same order as module_calls.
+    """
+
+    if concurrency < 1:
+        raise ValueError(f"concurrency must be at least 1, not {concurrency}")
+
+    module_names = [module_name for module_name, _ in module_calls]
+    found = await _find_modules(module_dirs, module_names)
+    calls = [
+        (module, os.path.basename(module), module_args)
+        for module, (_, module_args) in zip(found, module_calls)
+    ]
+
+    hosts = unique_hosts(inventory)
+    gates = _build_gates(hosts, module_dirs, list(dict.fromkeys(module_names)), dependencies)
+
+    async def run_on_gate(gate_process: SSHClientProcess) -> List[Dict]:
+        return await run_modules_through_gate(gate_process, calls)
+
+    async def run_on_host(host_name: str, host: Dict) -> Tuple[str, List[Dict]]:
+        if is_local(host):
+            results = []
+            for module, _, module_args in calls:
+                _, result = await run_module_locally(host_name, host, module, module_args)
+                results.append(result)
+            return host_name, results
+        else:
+            return await run_remotely(host_name, host, run_on_gate, gate_cache, gates)
+
+    return await _run_on_hosts(hosts, run_on_host, concurrency)
@@ -1,54 +1,274 @@
 
 
+import asyncio
+import logging
 import os
+import random
+import secrets
 import sys
-import uuid
-import base64
+import weakref
 import asyncssh
 import asyncssh.misc
 
 from asyncssh.connection import SSHClientConnection
 from asyncssh.process import SSHClientProcess
+from asyncssh.sftp import SFTPClient, SFTPAttrs
 
-from typing import Dict, Optional, Callable, cast, Tuple
-from .types import Gate
-from .message import send_message_str, read_message
-from .util import process_module_result
+from typing import Any, Awaitable, Dict, Optional, Callable, cast, Tuple, List, Set
+from .types import Gate, GateCache, GateKey
+from .message import send_message, send_message_with_payload, read_message
+from .util import process_module_result, read_module_bytes
+from .exceptions import GateStartFailed
+
+logger = logging.getLogger("faster_than_light.ssh")
+
+
+ConnectionKey = Tuple[str, Optional[str], Optional[int]]
+
+# Give up on unreachable hosts quickly and detect dead connections so that
+# a stuck host frees its slot and can be retried.
+SSH_OPTIONS = dict(
+    connect_timeout=10,
+    login_timeout=15,
+    keepalive_interval=15,
+    keepalive_count_max=3,
+)
+
+
+class ConnectionPool(object):
+
+    """
+    Shares SSH connections between gates on the same host, user, and port.
+
+    asyncssh multiplexes sessions over one connection so gates for inventory
+    hosts that resolve to the same address skip the TCP handshake, key
+    exchange, and authentication. Connections are reference counted and
+    closed when their last gate is closed. Each connection carries at most
+    max_gates gates to stay below the server's MaxSessions limit.
+
+    The temporary directory a gate was uploaded to is shared per host,
+    user, and port by the gates that use it, even on different
+    connections, and the last of those gates to close removes it from the
+    host. The SFTP client used for uploads is kept per connection so each
+    upload does not open a new SFTP channel.
+
+    At most max_connecting connections are opened at once so that large
+    inventories do not trip sshd's MaxStartups limit while gates on already
+    open connections keep running.
+    """
+
+    def __init__(self, max_gates: int = 4, max_connecting: int = 10) -> None:
+        self.max_gates = max_gates
+        self.connecting = asyncio.Semaphore(max_connecting)
+        self.connections: Dict[ConnectionKey, List[SSHClientConnection]] = {}
+        self.leases: Dict[SSHClientConnection, int] = {}
+        self.locks: Dict[ConnectionKey, asyncio.Lock] = {}
+        self.keys: Dict[SSHClientConnection, ConnectionKey] = {}
+        self.deployments: Dict[Tuple[ConnectionKey, str], str] = {}
+        self.deploy_locks: Dict[Tuple[ConnectionKey, str], asyncio.Lock] = {}
+        self.deployment_leases: Dict[Tuple[ConnectionKey, str], int] = {}
+        self.checked_interpreters: Set[Tuple[ConnectionKey, str]] = set()
+        self.sftp_clients: Dict[SSHClientConnection, SFTPClient] = {}
+
+    async def acquire(
+        self,
+        ssh_host: str,
+        ssh_user: Optional[str] = None,
+        ssh_port: Optional[int] = None,
+    ) -> SSHClientConnection:
+        key = (ssh_host, ssh_user, ssh_port)
+        async with self.locks.setdefault(key, asyncio.Lock()):
+            for conn in self.connections.get(key, []):
+                if self.leases[conn] < self.max_gates and not conn.is_closed():
+                    break
+            else:
+                options: Dict[str, Any] = dict(SSH_OPTIONS)
+                if ssh_user:
+                    options["username"] = ssh_user
+                if ssh_port:
+                    options["port"] = ssh_port
+                async with self.connecting:
+                    conn = await asyncssh.connect(ssh_host, **options)
+                self.connections.setdefault(key, []).append(conn)
+                self.keys[conn] = key
+                self.leases[conn] = 0
+            self.leases[conn] += 1
+            return conn
+
+    async def sftp_client(self, conn: SSHClientConnection) -> SFTPClient:
+        if conn not in self.sftp_clients:
+            self.sftp_clients[conn] = await conn.start_sftp_client()
+        return self.sftp_clients[conn]
+
+    def lease_deployment(self, conn: SSHClientConnection, tempdir: str) -> None:
+        key = (self.keys[conn], tempdir)
+        self.deployment_leases[key] = self.deployment_leases.get(key, 0) + 1
+
+    def release_deployment(self, conn: SSHClientConnection, tempdir: str) -> bool:
+
+        """
+        Returns True when the last gate using tempdir has released it.
+        """
+
+        key = (self.keys[conn], tempdir)
+        if key not in self.deployment_leases:
+            return False
+        self.deployment_leases[key] -= 1
+        if self.deployment_leases[key] > 0:
+            return False
+        del self.deployment_leases[key]
+        # Later gates upload to a new directory.
+        for deployment, deployed in list(self.deployments.items()):
+            if deployment[0] == key[0] and deployed == tempdir:
+                del self.deployments[deployment]
+        return True
+
+    def release(self, conn: SSHClientConnection) -> None:
+        if conn in self.leases:
+            self.leases[conn] -= 1
+            if self.leases[conn] > 0:
+                return
+            del self.leases[conn]
+            del self.keys[conn]
+            sftp = self.sftp_clients.pop(conn, None)
+            if sftp is not None:
+                sftp.exit()
+            for connections in self.connections.values():
+                if conn in connections:
+                    connections.remove(conn)
+        conn.close()
+
+
+# Connections belong to the event loop that opened them so keep one pool per loop.
+_connection_pools: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def get_connection_pool() -> ConnectionPool:
+    loop = asyncio.get_running_loop()
+    if loop not in _connection_pools:
+        _connection_pools[loop] = ConnectionPool()
+    return _connection_pools[loop]
+
+
+# Seconds to wait for a gate to answer Hello before giving up on it
+GATE_START_TIMEOUT = 10
+
+# Number of times to try connecting to a host before giving up
+RETRY_ATTEMPTS = 6
+
+
+def backoff(attempt: int, base: float = 0.5, cap: float = 30.0) -> float:
+
+    """
+    Returns a randomized delay before retry number attempt.
+
+    Full jitter keeps hosts that failed together from retrying together.
+    """
+
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def get_interpreter(host: Optional[Dict]) -> str:
+    if host and host.get("ansible_python_interpreter"):
+        return host["ansible_python_interpreter"]
+    else:
+        return sys.executable
 
 
 async def connect_gate(
-    gate_builder: Callable,
+    gate: str,
     ssh_host: str,
-    gate_cache: Optional[Dict[str, Gate]],
+    gate_cache: Optional[Dict[GateKey, Gate]],
     interpreter: str,
+    ssh_user: Optional[str] = None,
+    ssh_port: Optional[int] = None,
 ) -> Gate:
+    pool = get_connection_pool()
+    attempt = 0
     while True:
         try:
-            conn = await asyncssh.connect(ssh_host)
-            await check_version(conn, interpreter)
-            tempdir = f"/tmp/ftl-{uuid.uuid4()}"
-            result = await conn.run(f"mkdir {tempdir}", check=True)
-            result = await conn.run(
-                f'touch {os.path.join(tempdir, "args")}', check=True
-            )
-            assert result.exit_status == 0
-            await send_gate(gate_builder, conn, tempdir, interpreter)
-            gate_process = await open_gate(conn, tempdir)
-            return Gate(conn, gate_process, tempdir)
-        except ConnectionResetError:
-            print("retry connection")
-            await remove_item_from_cache(gate_cache)
-            continue
-        except asyncssh.misc.ConnectionLost:
-            print("retry connection")
+            conn = await pool.acquire(ssh_host, ssh_user, ssh_port)
+            tempdir = None
+            try:
+                tempdir = await deploy_gate(pool, conn, gate, interpreter)
+                try:
+                    gate_process = await open_gate(conn, tempdir)
+                except GateStartFailed:
+                    # The gate may have been removed from the host since it was uploaded.
+                    stale, tempdir = tempdir, None
+                    await remove_deployment(pool, conn, stale)
+                    tempdir = await deploy_gate(pool, conn, gate, interpreter, stale=stale)
+                    gate_process = await open_gate(conn, tempdir)
+                return Gate(conn, gate_process, tempdir)
+            except BaseException:
+                if tempdir is not None:
+                    await remove_deployment(pool, conn, tempdir)
+                pool.release(conn)
+                raise
+        except (ConnectionResetError, asyncssh.misc.ConnectionLost, asyncio.TimeoutError):
+            # Other errors such as PermissionDenied will not be fixed by retrying.
+            attempt += 1
+            if attempt >= RETRY_ATTEMPTS:
+                raise
+            logger.info("retry connection to %s", ssh_host)
             await remove_item_from_cache(gate_cache)
-            continue
+            await asyncio.sleep(backoff(attempt))
+
+
+async def deploy_gate(
+    pool: ConnectionPool,
+    conn: SSHClientConnection,
+    gate: str,
+    interpreter: str,
+    stale: Optional[str] = None,
+) -> str:
+
+    """
+    Returns the temporary directory that gate is uploaded to on the host of conn.
+
+    The gate is only uploaded when no open gate on the host already uses
+    it or when it was uploaded to stale. The caller holds a lease on the
+    directory until it calls remove_deployment.
+    """
+
+    key = (pool.keys[conn], gate)
+    async with pool.deploy_locks.setdefault(key, asyncio.Lock()):
+        tempdir = pool.deployments.get(key)
+        if tempdir is None or tempdir == stale:
+            # The name stays unpredictable since /tmp may be shared on the host.
+            tempdir = f"/tmp/ftl-{secrets.token_hex(8)}"
+            # The interpreter only needs to be checked once per host and is
+            # checked in the same round trip that creates the directory.
+            checked = (pool.keys[conn], interpreter)
+            if checked in pool.checked_interpreters:
+                await conn.run(f"mkdir {tempdir}", check=True)
+            else:
+                result = await conn.run(f"mkdir {tempdir} && {interpreter} --version", check=True)
+                check_python_version(result.stdout)
+                pool.checked_interpreters.add(checked)
+            await send_gate(gate, await pool.sftp_client(conn), tempdir)
+            pool.deployments[key] = tempdir
+        pool.lease_deployment(conn, tempdir)
+        return tempdir
+
+
+async def remove_deployment(pool: ConnectionPool, conn: SSHClientConnection, tempdir: str) -> None:
 
+    """
+    Releases a lease on tempdir and removes it from the host of conn when
+    no other gate uses it.
+    """
 
-async def check_version(conn: SSHClientConnection, interpreter: str) -> None:
-    result = await conn.run(f"{interpreter} --version")
-    if result.stdout:
-        output = cast(str, result.stdout)
+    if conn in pool.keys and pool.release_deployment(conn, tempdir):
+        try:
+            await conn.run(f"rm -rf {tempdir}", check=True)
+        except (asyncssh.Error, OSError) as e:
+            logger.warning("could not remove gate %s: %s", tempdir, e)
+
+
+def check_python_version(stdout) -> None:
+    if stdout:
+        output = cast(str, stdout)
         python_version = output.strip()
         for line in python_version.split("\n"):
             line = line.strip()
@@ -63,68 +283,125 @@ async def check_version(conn: SSHClientConnection, interpreter: str) -> None:
                 )
 
 
-async def send_gate(
-    gate_builder: Callable, conn: SSHClientConnection, tempdir: str, interpreter: str
-) -> None:
-    ftl_gate = gate_builder(interpreter=interpreter)
-    async with conn.start_sftp_client() as sftp:
-        await sftp.put(ftl_gate, f"{tempdir}/ftl_gate.pyz")
-    result = await conn.run(f"chmod 700 {tempdir}/ftl_gate.pyz", check=True)
-    assert result.exit_status == 0
+async def send_gate(gate: str, sftp: SFTPClient, tempdir: str) -> None:
+    # The gate is read from disk once and the same bytes are sent to every host.
+    loop = asyncio.get_running_loop()
+    gate_bytes = await loop.run_in_executor(None, read_module_bytes, gate)
+    # Create the gate executable so that it does not need a chmod before it is run.
+    async with sftp.open(
+        f"{tempdir}/ftl_gate.pyz", "wb", SFTPAttrs(permissions=0o700)
+    ) as f:
+        await f.write(gate_bytes)
 
 
 async def open_gate(conn: SSHClientConnection, tempdir: str) -> SSHClientProcess:
-    process = await conn.create_process(f"{tempdir}/ftl_gate.pyz")
-    send_message_str(process.stdin, "Hello", {})
-    if await read_message(process.stdout) != ["Hello", {}]:
-        error = await process.stderr.read()
-        print(error)
-        raise Exception(error)
+    process = await conn.create_process(f"exec {tempdir}/ftl_gate.pyz", encoding=None)
+    send_message(process.stdin, "Hello", {})
+    try:
+        reply = await asyncio.wait_for(read_message(process.stdout), GATE_START_TIMEOUT)
+    except asyncio.TimeoutError:
+        # Close the gate so that stderr ends instead of waiting for the gate.
+        process.close()
+        reply = None
+    if reply != ["Hello", {}]:
+        error = (await process.stderr.read()).decode()[:2048]
+        logger.debug("gate failed to start: %s", error)
+        raise GateStartFailed(error)
     return process
 
 
-async def remove_item_from_cache(gate_cache: Optional[Dict[str, Gate]]) -> None:
+async def remove_item_from_cache(gate_cache: Optional[Dict[GateKey, Gate]]) -> None:
     if gate_cache is not None and gate_cache:
-        item, (conn, gate_process, tempdir) = gate_cache.popitem()
+        # Gates are added back to the cache after each use so the first gate
+        # is the least recently used.
+        item = next(iter(gate_cache))
+        conn, gate_process, tempdir = gate_cache.pop(item)
         await close_gate(conn, gate_process, tempdir)
-        print("closed gate", item)
+        logger.debug("closed gate %s", item)
 
 
 async def close_gate(conn, gate_process, tempdir: str) -> None:
 
+    pool = get_connection_pool()
     try:
         if gate_process is not None:
-            send_message_str(gate_process.stdin, "Shutdown", {})
+            send_message(gate_process.stdin, "Shutdown", {})
         if gate_process is not None and gate_process.exit_status is not None:
             await gate_process.stderr.read()
     finally:
-        conn.close()
-    # result = await conn.run(f'rm -rf {tempdir}', check=True)
-    # assert result.exit_status == 0
+        # The temporary directory is removed over the connection the gate
+        # still holds once no other gate uses it.
+        try:
+            await remove_deployment(pool, conn, tempdir)
+        finally:
+            pool.release(conn)
+
+
+async def clean_up_gates(gate_cache: Optional[Dict[GateKey, Gate]] = None) -> None:
+
+    """
+    Shuts down the gates in gate_cache and removes them from their hosts.
+    """
+
+    if not gate_cache:
+        return
+    gates = list(gate_cache.values())
+    gate_cache.clear()
+    results = await asyncio.gather(
+        *[close_gate(*gate) for gate in gates],
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, Exception):
+            logger.warning("could not close gate: %s", result)
 
 
 async def run_module_through_gate(
     gate_process: SSHClientProcess, module: str, module_name: str, module_args: Dict
 ) -> Dict:
-    with open(module, "rb") as f:
-        module_text = base64.b64encode(f.read()).decode()
-    send_message_str(
+    send_message_with_payload(
         gate_process.stdin,
         "Module",
-        dict(module=module_text, module_name=module_name, module_args=module_args),
+        dict(module_name=module_name, module_args=module_args),
+        read_module_bytes(module),
     )
     return process_module_result(await read_message(gate_process.stdout))
 
 
+async def run_modules_through_gate(
+    gate_process: SSHClientProcess, modules: List[Tuple[str, str, Dict]]
+) -> List[Dict]:
+
+    """
+    Runs several modules on one gate.
+
+    All of the Module messages are sent before any result is read so that
+    the modules are pipelined instead of waiting a round trip for each one.
+    The gate handles messages in order so the results are in the same order
+    as modules.
+    """
+
+    for module, module_name, module_args in modules:
+        send_message_with_payload(
+            gate_process.stdin,
+            "Module",
+            dict(module_name=module_name, module_args=module_args),
+            read_module_bytes(module),
+        )
+    return [
+        process_module_result(await read_message(gate_process.stdout))
+        for _ in modules
+    ]
+
+
 async def run_ftl_module_through_gate(
     gate_process: SSHClientProcess, module: str, module_name: str, module_args: Dict
 ) -> Dict:
-    with open(module, "rb") as f:
-        module_text = base64.b64encode(f.read()).decode()
-    send_message_str(
+    send_message_with_payload(
         gate_process.stdin,
         "FTLModule",
-        dict(module=module_text, module_name=module_name, module_args=module_args),
+        dict(module_name=module_name, module_args=module_args),
+        read_module_bytes(module),
     )
     return process_module_result(await read_message(gate_process.stdout))
 
@@ -135,41 +412,76 @@ async def run_module_remotely(
     module: str,
     module_args: Dict,
     remote_runner: Callable,
-    gate_cache: Optional[Dict[str, Gate]],
-    gate_builder: Callable,
+    gate_cache: Optional[Dict[GateKey, Gate]],
+    gates: Dict[str, str],
 ) -> Tuple[str, Dict]:
     module_name = os.path.basename(module)
+
+    async def run(gate_process: SSHClientProcess) -> Dict:
+        return await remote_runner(gate_process, module, module_name, module_args)
+
+    return await run_remotely(host_name, host, run, gate_cache, gates)
+
+
+async def run_remotely(
+    host_name: str,
+    host: Dict,
+    runner: Callable[[SSHClientProcess], Awaitable[Any]],
+    gate_cache: Optional[Dict[GateKey, Gate]],
+    gates: Dict[str, str],
+) -> Tuple[str, Any]:
+
+    """
+    Calls runner with a gate on the host and returns its result.
+    """
+
     if host and host.get("ansible_host"):
         ssh_host = host.get("ansible_host")
     else:
         ssh_host = host_name
-    if host and host.get("ansible_python_interpreter"):
-        interpreter = host.get("ansible_python_interpreter")
-    else:
-        interpreter = sys.executable
+    interpreter = get_interpreter(host)
+    ssh_user = host.get("ansible_user") if host else None
+    # Different users or interpreters on the same host need different gates.
+    key = (host_name, ssh_user, interpreter)
+    attempt = 0
     while True:
         try:
-            if gate_cache is not None and gate_cache.get(host_name):
-                conn, gate_process, tempdir = gate_cache[host_name]
-                del gate_cache[host_name]
+            if gate_cache is not None and gate_cache.get(key):
+                # The gate is removed while it is in use and added back at the
+                # end so the cache stays in least recently used order.
+                conn, gate_process, tempdir = gate_cache.pop(key)
             else:
                 conn, gate_process, tempdir = await connect_gate(
-                    gate_builder, ssh_host, gate_cache, interpreter
+                    gates[interpreter],
+                    ssh_host,
+                    gate_cache,
+                    interpreter,
+                    ssh_user,
+                    host.get("ansible_port") if host else None,
                 )
             try:
-                return host_name, await remote_runner(
-                    gate_process, module, module_name, module_args
-                )
+                return host_name, await runner(gate_process)
             finally:
                 if gate_cache is None:
                     await close_gate(conn, gate_process, tempdir)
+                elif gate_cache.get(key):
+                    # Another run on this host cached its gate while this one
+                    # was running.  Gates share the pooled connection so
+                    # closing this one only closes its channel.
+                    await close_gate(conn, gate_process, tempdir)
                 else:
-                    gate_cache[host_name] = Gate(conn, gate_process, tempdir)
+                    gate_cache[key] = Gate(conn, gate_process, tempdir)
+                    if isinstance(gate_cache, GateCache) and gate_cache.max_gates is not None:
+                        while len(gate_cache) > gate_cache.max_gates:
+                            await remove_item_from_cache(gate_cache)
             break
         except ConnectionResetError:
-            print("retry connection")
-            # Randomly close a connection in the cache
+            attempt += 1
+            if attempt >= RETRY_ATTEMPTS:
+                raise
+            logger.info("retry connection to %s", host_name)
+            # Close the least recently used gate in the cache
             await remove_item_from_cache(gate_cache)
-            continue
+            await asyncio.sleep(backoff(attempt))
 
     return host_name, None
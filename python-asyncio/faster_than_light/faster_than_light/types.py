@@ -1,6 +1,5 @@
-
-
-from typing import NamedTuple, Any
+from collections import OrderedDict
+from typing import NamedTuple, Any, Optional, Tuple
 
 from asyncssh.connection import SSHClientConnection
 from asyncssh.process import SSHClientProcess
@@ -10,3 +9,22 @@ class Gate(NamedTuple):
     conn: SSHClientConnection
     gate_process: SSHClientProcess
     temp_dir: str
+
+
+# Gates are cached by host name, ssh user, and interpreter
+GateKey = Tuple[str, Optional[str], str]
+
+
+class GateCache(OrderedDict):
+
+    """
+    A gate cache that evicts the least recently used gate.
+
+    Gates are moved to the end when they are used so the first gate is the
+    least recently used. When max_gates is set the oldest gates are closed
+    as new gates are added beyond it.
+    """
+
+    def __init__(self, max_gates: Optional[int] = None) -> None:
+        super().__init__()
+        self.max_gates = max_gates
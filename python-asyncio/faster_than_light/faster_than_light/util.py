@@ -1,23 +1,73 @@
-import glob
+import asyncio
 import os
 import shutil
-import json
+import sys
 
-from typing import List, Union, Dict
-from .message import GateMessage
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from itertools import islice
+from typing import Any, Coroutine, List, Union, Dict, Tuple, FrozenSet, Iterable, Iterator
+from .message import GateMessage, module_json_loads
 from .exceptions import ModuleNotFound
 
 
+@lru_cache(maxsize=256)
+def _expand_directory(d: str) -> str:
+    return os.path.expanduser(d)
+
+
 def ensure_directory(d: str) -> str:
-    d = os.path.abspath(os.path.expanduser(d))
-    if not os.path.exists(d):
-        os.makedirs(d)
+
+    """
+    Creates the directory d if it does not exist and returns its absolute path.
+    """
+
+    d = os.path.abspath(_expand_directory(d))
+    # makedirs with exist_ok avoids a separate exists check and the race
+    # between checking and creating the directory.
+    os.makedirs(d, exist_ok=True)
     return d
 
 
-def chunk(lst: List, n: int):
-    for i in range(0, len(lst), n):
-        yield lst[i: i + n]
+def chunk(lst: Iterable, n: int) -> Iterator[List]:
+
+    """
+    Yields lists of up to n items from lst.
+
+    lst can be any iterable, so hosts can be batched without first
+    copying them into a list.
+    """
+
+    it = iter(lst)
+    while True:
+        batch = list(islice(it, n))
+        if not batch:
+            return
+        yield batch
+
+
+@lru_cache(maxsize=64)
+def _list_module_dir(module_dir: str, mtime: int) -> FrozenSet[str]:
+
+    with os.scandir(module_dir) as entries:
+        return frozenset(entry.name for entry in entries)
+
+
+def list_module_dir(module_dir: str) -> FrozenSet[str]:
+
+    """
+    Returns the names of the files in module_dir.
+
+    One scandir replaces a stat per candidate module and the listing is
+    cached until the directory is modified.
+    """
+
+    try:
+        return _list_module_dir(
+            os.path.abspath(module_dir), os.stat(module_dir).st_mtime_ns
+        )
+    except OSError:
+        return frozenset()
 
 
 def find_module(module_dirs: List[str], module_name: str) -> Union[str, None]:
@@ -26,28 +76,33 @@ def find_module(module_dirs: List[str], module_name: str) -> Union[str, None]:
     Finds a module file path in the module_dirs with the name module_name.
 
     Returns a file path.
+
+    Each lookup checks the cached listings of module_dirs, which are
+    refreshed when a directory is modified, so added and removed modules
+    are seen on the next lookup.
     """
 
-    module = None
+    # Names with a directory part are not in the listings so check the file system.
+    if os.path.dirname(module_name):
+        listings = None
+    else:
+        listings = [list_module_dir(d) for d in module_dirs]
 
-    # Find the module in module_dirs
-    for d in module_dirs:
-        module = os.path.join(d, f"{module_name}.py")
-        if os.path.exists(module):
-            break
-        else:
-            module = None
-
-    # Look for binary module in module_dirs
-    if module is None:
-        for d in module_dirs:
-            module = os.path.join(d, module_name)
-            if os.path.exists(module):
-                break
+    # Find the module in module_dirs then look for binary module in module_dirs
+    if module_name.endswith(".py"):
+        names: Tuple[str, ...] = (module_name,)
+    else:
+        names = (f"{module_name}.py", module_name)
+    for name in names:
+        for i, d in enumerate(module_dirs):
+            if listings is None:
+                found = os.path.exists(os.path.join(d, name))
             else:
-                module = None
+                found = name in listings[i]
+            if found:
+                return os.path.join(d, name)
 
-    return module
+    return None
 
 
 def read_module(module_dirs: List[str], module_name: str) -> bytes:
@@ -55,35 +110,117 @@ def read_module(module_dirs: List[str], module_name: str) -> bytes:
     module = find_module(module_dirs, module_name)
 
     if module:
-        with open(module, "rb") as f:
-            return f.read()
+        return read_module_bytes(module)
     else:
         raise ModuleNotFound(f"Cannot find {module_name} in {module_dirs}")
 
 
+@lru_cache(maxsize=64)
+def _read_module_bytes(module: str, mtime: int) -> bytes:
+
+    with open(module, "rb") as f:
+        return f.read()
+
+
+def read_module_bytes(module: str) -> bytes:
+
+    """
+    Reads the contents of a module file.
+
+    The contents are cached until the file is modified so that a module
+    sent to many hosts is only read from disk once.
+    """
+
+    return _read_module_bytes(module, os.stat(module).st_mtime_ns)
+
+
+@lru_cache(maxsize=64)
+def _classify_module(module: str, mtime: int) -> Tuple[bool, bool, bool]:
+
+    module_bytes = read_module_bytes(module)
+    try:
+        module_bytes.decode()
+    except UnicodeDecodeError:
+        return True, False, False
+    return False, b"AnsibleModule(" in module_bytes, b"WANT_JSON" in module_bytes
+
+
+def classify_module(module: str) -> Tuple[bool, bool, bool]:
+
+    """
+    Returns whether a module is binary, new style, and wants JSON arguments.
+
+    The module is read once for all three checks and the result is cached
+    until the file is modified.
+    """
+
+    return _classify_module(module, os.stat(module).st_mtime_ns)
+
+
+def run_fast_loop(main: Coroutine) -> Any:
+
+    """
+    Runs main on a uvloop event loop if uvloop is installed.
+    """
+
+    try:
+        import uvloop  # type: ignore
+    except ImportError:
+        return asyncio.run(main)
+    if sys.version_info >= (3, 11):
+        with asyncio.Runner(loop_factory=uvloop.new_event_loop) as runner:
+            return runner.run(main)
+    elif hasattr(uvloop, "run"):
+        return uvloop.run(main)
+    return asyncio.run(main)
+
+
+def clear_module_cache() -> None:
+
+    """
+    Forgets the directory listings used by find_module.
+    """
+
+    _list_module_dir.cache_clear()
+
+
 def clean_up_ftl_cache() -> None:
+    clear_module_cache()
     cache = os.path.abspath(os.path.expanduser("~/.ftl"))
     if os.path.exists(cache) and os.path.isdir(cache) and ".ftl" in cache:
         shutil.rmtree(cache)
 
 
 def clean_up_tmp() -> None:
-    for d in glob.glob("/tmp/ftl-*"):
-        if os.path.exists(d) and os.path.isdir(d) and "tmp" in d and "ftl" in d:
+    # scandir returns the file type with each entry so no stat is needed.
+    with os.scandir("/tmp") as entries:
+        tempdirs = [
+            entry.path
+            for entry in entries
+            if entry.name.startswith("ftl-") and entry.is_dir(follow_symlinks=False)
+        ]
+    if len(tempdirs) > 1:
+        # rmtree is bound by unlink calls so removing the directories in
+        # threads overlaps the file system latency.
+        with ThreadPoolExecutor() as executor:
+            list(executor.map(shutil.rmtree, tempdirs))
+    else:
+        for d in tempdirs:
             shutil.rmtree(d)
 
 
 def process_module_result(message: GateMessage) -> Dict:
     msg_type = message[0]
     if msg_type == "ModuleResult":
-        if message[1].get("stdout", None):
-            return json.loads(message[1]["stdout"])
+        stdout = message[1].get("stdout", None)
+        if stdout:
+            return module_json_loads(stdout)
         else:
-            return dict(error=dict(message=message[1]["stderr"]))
+            return {"error": {"message": message[1]["stderr"]}}
     if msg_type == "FTLModuleResult":
         if message[1].get("result", None):
             return message[1]["result"]
     elif msg_type == "GateSystemError":
-        return dict(error=dict(error_type=message[0], message=message[1]))
+        return {"error": {"error_type": message[0], "message": message[1]}}
     else:
         raise Exception(f"Unsupported message type {msg_type}")
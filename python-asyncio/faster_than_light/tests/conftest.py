@@ -0,0 +1,38 @@
+import os
+import shutil
+import subprocess
+import pytest
+
+from faster_than_light.gate import build_ftl_gate
+from faster_than_light.util import clean_up_ftl_cache, clean_up_tmp
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+@pytest.fixture(autouse=True)
+def clean_up():
+    # Clean up after every test even when it fails.
+    yield
+    clean_up_ftl_cache()
+    clean_up_tmp()
+
+
+@pytest.fixture(scope="session")
+def ftl_gate(tmp_path_factory):
+    # Tests remove ~/.ftl so the gate is copied out of the cache to keep
+    # one build for the whole session.
+    os.chdir(HERE)
+    gate = str(tmp_path_factory.mktemp("gate") / "ftl_gate.pyz")
+    shutil.copy(build_ftl_gate(), gate)
+    yield gate
+    os.unlink(gate)
+
+
+@pytest.fixture(scope="session")
+def c_module():
+    # Only run gcc when the source is newer than the built module.
+    source = os.path.join(HERE, "modules", "c_module.c")
+    module = os.path.join(HERE, "modules", "c_module")
+    if not os.path.exists(module) or os.stat(source).st_mtime_ns > os.stat(module).st_mtime_ns:
+        subprocess.check_call(["gcc", source, "-o", module])
+    return module
@@ -0,0 +1,3 @@
+#!/usr/bin/python3
+
+print('{"value": NaN, "limit": Infinity}')
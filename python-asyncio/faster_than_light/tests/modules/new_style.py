@@ -5,15 +5,24 @@
 
 import os
 import sys
-import json
-import glob
+
+try:
+    import orjson
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    import json
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':'))
 
 args = sys.argv
 with open(sys.argv[0]) as f:
     executable = f.read()
-files = glob.glob(os.path.join(os.path.dirname(sys.argv[0]), '*'))
+files = [e.path for e in os.scandir(os.path.dirname(sys.argv[0]) or '.')]
 
-print(json.dumps({
+print(dumps({
     "args" : args,
     "executable": executable,
     "files": files
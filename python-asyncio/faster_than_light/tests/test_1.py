@@ -1,18 +1,32 @@
 
 
 import os
+import math
+import asyncio
 import pytest
-import subprocess
-from pprint import pprint
+import logging
 from faster_than_light.inventory import load_inventory
-from faster_than_light.local import check_output
-from faster_than_light.module import run_module, run_ftl_module
-from faster_than_light.util import clean_up_ftl_cache, clean_up_tmp
+from faster_than_light.local import check_output, stage_module, remove_staged_modules
+from faster_than_light.module import run_module, run_modules, run_ftl_module, unique_hosts, _run_module
+from faster_than_light.util import clean_up_tmp
 from faster_than_light.exceptions import ModuleNotFound
-from faster_than_light.ssh import remove_item_from_cache
+from faster_than_light.ssh import remove_item_from_cache, get_connection_pool
+from faster_than_light.types import GateCache
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 
+logger = logging.getLogger(__name__)
+
+
+def test_unique_hosts():
+    inventory = {'all': {'hosts': {'a': {}, 'b': {'ansible_host': 'b'}}},
+                 'group1': {'hosts': {'b': None}},
+                 'group2': {'vars': {}},
+                 'group3': {'hosts': None}}
+    assert unique_hosts(inventory) == {'a': {}, 'b': None}
+    inventory['group2']['hosts'] = {'c': {}}
+    assert unique_hosts(inventory) == {'a': {}, 'b': None, 'c': {}}
+
 
 @pytest.mark.asyncio
 async def test_checkoutput():
@@ -20,8 +34,6 @@ async def test_checkoutput():
     output = await check_output('ping')
     print(output)
     assert output
-    clean_up_ftl_cache()
-    clean_up_tmp()
 
 
 @pytest.mark.asyncio
@@ -35,10 +47,8 @@ async def test_run_module_not_found():
 async def test_run_module_timetest():
     os.chdir(HERE)
     output = await run_module(load_inventory('inventory.yml'), ['modules'], 'timetest')
-    pprint(output)
+    logger.debug("%r", output)
     assert output['localhost']
-    clean_up_ftl_cache()
-    clean_up_tmp()
 
 
 @pytest.mark.asyncio
@@ -48,14 +58,12 @@ async def test_run_module_argtest():
                               ['modules'],
                               'argtest',
                               module_args=dict(somekey='somevalue'))
-    pprint(output)
+    logger.debug("%r", output)
     assert output['localhost']
     assert output['localhost']['args']
     assert output['localhost']['executable']
     assert output['localhost']['more_args'] == 'somekey=somevalue'
     assert output['localhost']['files']
-    clean_up_ftl_cache()
-    clean_up_tmp()
 
 
 @pytest.mark.asyncio
@@ -65,14 +73,12 @@ async def test_run_module_argtest_remote():
                               ['modules'],
                               'argtest',
                               module_args=dict(somekey='somevalue'))
-    pprint(output)
+    logger.debug("%r", output)
     assert output['localhost']
     assert output['localhost']['args']
     assert output['localhost']['executable']
     assert output['localhost']['more_args'] == 'somekey=somevalue'
     assert output['localhost']['files']
-    clean_up_ftl_cache()
-    clean_up_tmp()
 
 
 @pytest.mark.asyncio
@@ -81,11 +87,9 @@ async def test_run_ftl_module():
     output = await run_ftl_module(load_inventory('inventory.yml'),
                                   ['ftl_modules'],
                                   'argtest')
-    pprint(output)
+    logger.debug("%r", output)
     assert output['localhost']
     assert output['localhost'] == {'args': (), 'kwargs': {}}
-    clean_up_ftl_cache()
-    clean_up_tmp()
 
 
 @pytest.mark.asyncio
@@ -94,11 +98,9 @@ async def test_run_ftl_module_remote():
     output = await run_ftl_module(load_inventory('inventory2.yml'),
                                   ['ftl_modules'],
                                   'argtest')
-    pprint(output)
+    logger.debug("%r", output)
     assert output['localhost']
     assert output['localhost'] == {'args': [], 'kwargs': {}}
-    clean_up_ftl_cache()
-    clean_up_tmp()
 
 
 @pytest.mark.asyncio
@@ -108,14 +110,12 @@ async def test_run_module_want_json():
                               ['modules'],
                               'want_json',
                               module_args=dict(somekey='somevalue'))
-    pprint(output)
+    logger.debug("%r", output)
     assert output['localhost']
     assert output['localhost']['args']
     assert output['localhost']['executable']
     assert output['localhost']['more_args'] == '{"somekey": "somevalue"}'
     assert output['localhost']['files']
-    clean_up_ftl_cache()
-    clean_up_tmp()
 
 
 @pytest.mark.asyncio
@@ -125,27 +125,21 @@ async def test_run_module_new_style():
                               ['modules'],
                               'new_style',
                               module_args=dict(somekey='somevalue'))
-    pprint(output)
+    logger.debug("%r", output)
     assert output['localhost']
     assert output['localhost']['args']
     assert output['localhost']['executable']
     assert output['localhost']['files']
-    clean_up_ftl_cache()
-    clean_up_tmp()
 
 @pytest.mark.asyncio
-async def test_run_module_c_module():
-    os.chdir(os.path.join(HERE, 'modules'))
-    subprocess.check_output('gcc c_module.c -o c_module', shell=True)
+async def test_run_module_c_module(c_module):
     os.chdir(HERE)
     output = await run_module(load_inventory('inventory.yml'),
                               ['modules'],
                               'c_module',
                               module_args=dict(somekey='somevalue'))
-    pprint(output)
+    logger.debug("%r", output)
     assert output['localhost']
-    clean_up_ftl_cache()
-    clean_up_tmp()
 
 @pytest.mark.asyncio
 async def test_run_module_bad_output():
@@ -154,11 +148,64 @@ async def test_run_module_bad_output():
                               ['modules'],
                               'bad_output',
                               module_args=dict(somekey='somevalue'))
-    pprint(output)
+    logger.debug("%r", output)
     assert output['localhost']
     assert output['localhost']['error']
-    clean_up_ftl_cache()
-    clean_up_tmp()
+
+
+@pytest.mark.asyncio
+async def test_run_modules():
+    os.chdir(HERE)
+    output = await run_modules(load_inventory('inventory.yml'),
+                               ['modules'],
+                               [('argtest', dict(somekey='somevalue')),
+                                ('want_json', dict(somekey='somevalue'))])
+    logger.debug("%r", output)
+    first, second = output['localhost']
+    assert first['more_args'] == 'somekey=somevalue'
+    assert second['more_args'] == '{"somekey": "somevalue"}'
+
+
+@pytest.mark.asyncio
+async def test_run_modules_remote():
+    os.chdir(HERE)
+    cache = dict()
+    output = await run_modules(load_inventory('inventory2.yml'),
+                               ['modules'],
+                               [('argtest', dict(somekey='somevalue')),
+                                ('want_json', dict(somekey='somevalue')),
+                                ('argtest', dict(otherkey='othervalue'))],
+                               gate_cache=cache)
+    logger.debug("%r", output)
+    first, second, third = output['localhost']
+    assert first['more_args'] == 'somekey=somevalue'
+    assert second['more_args'] == '{"somekey": "somevalue"}'
+    assert third['more_args'] == 'otherkey=othervalue'
+    assert len(cache) == 1
+    while cache:
+        await remove_item_from_cache(cache)
+
+
+@pytest.mark.asyncio
+async def test_run_module_nan_result():
+    os.chdir(HERE)
+    output = await run_module(load_inventory('inventory.yml'),
+                              ['modules'],
+                              'nan_result')
+    logger.debug("%r", output)
+    assert math.isnan(output['localhost']['value'])
+    assert output['localhost']['limit'] == math.inf
+
+
+@pytest.mark.asyncio
+async def test_run_module_nan_result_remote():
+    os.chdir(HERE)
+    output = await run_module(load_inventory('inventory2.yml'),
+                              ['modules'],
+                              'nan_result')
+    logger.debug("%r", output)
+    assert math.isnan(output['localhost']['value'])
+    assert output['localhost']['limit'] == math.inf
 
 
 @pytest.mark.asyncio
@@ -170,7 +217,7 @@ async def test_run_module_argtest_remote_cached():
                               'argtest',
                               module_args=dict(somekey='somevalue'),
                               gate_cache=cache)
-    pprint(output)
+    logger.debug("%r", output)
     assert output['localhost']
     assert output['localhost']['args']
     assert output['localhost']['executable']
@@ -179,8 +226,6 @@ async def test_run_module_argtest_remote_cached():
     assert cache
     await remove_item_from_cache(cache)
     assert not cache 
-    clean_up_ftl_cache()
-    clean_up_tmp()
 
 
 @pytest.mark.asyncio
@@ -192,7 +237,7 @@ async def test_run_module_argtest_remote_cached2():
                               'argtest',
                               module_args=dict(somekey='somevalue'),
                               gate_cache=cache)
-    pprint(output)
+    logger.debug("%r", output)
     assert output['localhost']
     assert output['localhost']['args']
     assert output['localhost']['executable']
@@ -204,7 +249,7 @@ async def test_run_module_argtest_remote_cached2():
                               'argtest',
                               module_args=dict(somekey='somevalue'),
                               gate_cache=cache)
-    pprint(output)
+    logger.debug("%r", output)
     assert output['localhost']
     assert output['localhost']['args']
     assert output['localhost']['executable']
@@ -213,8 +258,6 @@ async def test_run_module_argtest_remote_cached2():
     assert cache
     await remove_item_from_cache(cache)
     assert not cache 
-    clean_up_ftl_cache()
-    clean_up_tmp()
 
 
 @pytest.mark.asyncio
@@ -226,7 +269,7 @@ async def test_run_module_argtest_host():
                               'argtest',
                               module_args=dict(somekey='somevalue'),
                               gate_cache=cache)
-    pprint(output)
+    logger.debug("%r", output)
     assert output['localhost']
     assert output['localhost']['args']
     assert output['localhost']['executable']
@@ -235,5 +278,72 @@ async def test_run_module_argtest_host():
     assert cache
     await remove_item_from_cache(cache)
     assert not cache 
-    clean_up_ftl_cache()
+
+
+@pytest.mark.asyncio
+async def test_run_module_host_error():
+    os.chdir(HERE)
+
+    async def local_runner(host_name, host, module, module_args):
+        if host_name == 'bad':
+            raise Exception('bad host')
+        return host_name, dict(ok=True)
+
+    inventory = {'all': {'hosts': {'good': {'ansible_connection': 'local'},
+                                   'bad': {'ansible_connection': 'local'}}}}
+    output = await _run_module(inventory, ['modules'], 'argtest',
+                               local_runner, None, None, None, None, None)
+    assert output['good'] == dict(ok=True)
+    assert output['bad'] == {'error': {'error_type': 'Exception', 'message': 'bad host'}}
+
+
+@pytest.mark.asyncio
+async def test_run_module_bad_concurrency():
+    os.chdir(HERE)
+    with pytest.raises(ValueError):
+        await run_module(load_inventory('inventory.yml'), ['modules'], 'argtest', concurrency=0)
+
+
+def test_stage_module():
+    os.chdir(HERE)
+    staged = stage_module('modules/argtest.py')
+    assert stage_module('modules/argtest.py') == staged
     clean_up_tmp()
+    staged = stage_module('modules/argtest.py')
+    assert os.path.exists(staged)
+    remove_staged_modules()
+    assert not os.path.exists(staged)
+
+
+@pytest.mark.asyncio
+async def test_run_module_gate_cache_max_gates():
+    os.chdir(HERE)
+    cache = GateCache(max_gates=1)
+    inventory = {'all': {'hosts': {'host1': {'ansible_host': 'localhost'},
+                                   'host2': {'ansible_host': 'localhost'}}}}
+    output = await run_module(inventory,
+                              ['modules'],
+                              'argtest',
+                              module_args=dict(somekey='somevalue'),
+                              gate_cache=cache)
+    assert output['host1']['more_args'] == 'somekey=somevalue'
+    assert output['host2']['more_args'] == 'somekey=somevalue'
+    assert len(cache) == 1
+    await remove_item_from_cache(cache)
+    assert not cache
+
+
+@pytest.mark.asyncio
+async def test_run_module_gate_cache_concurrent():
+    os.chdir(HERE)
+    cache = dict()
+    outputs = await asyncio.gather(*[run_module(load_inventory('inventory2.yml'),
+                                                ['modules'],
+                                                'argtest',
+                                                module_args=dict(somekey='somevalue'),
+                                                gate_cache=cache) for _ in range(3)])
+    for output in outputs:
+        assert output['localhost']['more_args'] == 'somekey=somevalue'
+    assert len(cache) == 1
+    await remove_item_from_cache(cache)
+    assert not get_connection_pool().leases
@@ -35,6 +35,16 @@ async def test_cli_argtest():
 async def test_cli_argtest2():
     await faster_than_light.cli.main(['-M', 'modules', '-m', 'argtest', '-i', 'inventory.yml'])
 
+@pytest.mark.asyncio
+async def test_cli_argtest_concurrency():
+    await faster_than_light.cli.main(['-M', 'modules', '-m', 'argtest', '-i', 'inventory.yml', '-c', '1'])
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("concurrency", ['0', 'many'])
+async def test_cli_bad_concurrency(concurrency):
+    with pytest.raises(docopt.DocoptExit):
+        await faster_than_light.cli.main(['-M', 'modules', '-m', 'argtest', '-i', 'inventory.yml', '-c', concurrency])
+
 @pytest.mark.asyncio
 async def test_cli_ftl_argtest():
     await faster_than_light.cli.main(['-M', 'ftl_modules', '-f', 'argtest', '-i', 'inventory.yml', '-a', 'somekey=somevalue'])
@@ -44,15 +54,10 @@ async def test_cli_ftl_argtest():
 async def test_cli_argtest():
     await faster_than_light.cli.main(['-M', 'modules', '-m', 'argtest', '-i', 'inventory.yml', '-a', 'somekey=somevalue', '--requirements', 'requirements.txt'])
 
-def test_builder_cli():
-    faster_than_light.builder.main([])
+@pytest.mark.parametrize("args", [[], ['--debug'], ['--verbose']], ids=["default", "debug", "verbose"])
+def test_builder_cli(args):
+    faster_than_light.builder.main(args)
 
 
 def test_builder_cli2():
     faster_than_light.builder.main(['-M', 'modules', '-m', 'argtest', '--requirements', 'requirements.txt', '--interpreter', sys.executable])
-
-def test_builder_cli_debug():
-    faster_than_light.builder.main(['--debug'])
-
-def test_builder_cli_verbose():
-    faster_than_light.builder.main(['--verbose'])
@@ -2,22 +2,20 @@ import asyncio
 import os
 import pytest
 import base64
-from pprint import pprint
 
-from faster_than_light.message import read_message, send_message
+from faster_than_light.message import read_message, send_message, send_message_with_payload
 from faster_than_light.gate import build_ftl_gate
 from faster_than_light.module import run_module_on_host, find_module
-from faster_than_light.util import clean_up_ftl_cache, clean_up_tmp
+from faster_than_light.util import read_module
 from faster_than_light.exceptions import ModuleNotFound
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 
 
 @pytest.mark.asyncio
-async def test_read_message():
+async def test_read_message(ftl_gate):
     os.chdir(HERE)
-    ftl_gate = build_ftl_gate()
-    proc = await asyncio.create_subprocess_shell(
+    proc = await asyncio.create_subprocess_exec(
         ftl_gate,
         stdin=asyncio.subprocess.PIPE,
         stdout=asyncio.subprocess.PIPE,
@@ -26,6 +24,7 @@ async def test_read_message():
 
     try:
         proc.stdin.write(b'0000000d["Hello", {}]')
+        await proc.stdin.drain()
         message = await read_message(proc.stdout)
         assert message[0] == "Hello"
         assert message[1] == {}
@@ -35,9 +34,16 @@ async def test_read_message():
     finally:
         send_message(proc.stdin, "Shutdown", {})
         await proc.wait()
-        os.unlink(ftl_gate)
-        clean_up_ftl_cache()
-        clean_up_tmp()
+
+
+@pytest.mark.asyncio
+async def test_read_message_split():
+    reader = asyncio.StreamReader()
+    reader.feed_data(b'0000000d["Hel')
+    asyncio.get_running_loop().call_soon(reader.feed_data, b'lo", {}]')
+    assert await read_message(reader) == ["Hello", {}]
+    reader.feed_eof()
+    assert await read_message(reader) is None
 
 
 @pytest.mark.asyncio
@@ -49,12 +55,12 @@ async def test_build_ftl_gate_module_not_found():
 @pytest.mark.asyncio
 async def test_build_ftl_gate():
     os.chdir(HERE)
-    ftl_gate = build_ftl_gate()
-    proc = await asyncio.create_subprocess_shell(
+    ftl_gate = build_ftl_gate(modules=["argtest"], module_dirs=["modules"])
+    proc = await asyncio.create_subprocess_exec(
         ftl_gate,
         stdin=asyncio.subprocess.PIPE,
         stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
     )
 
     try:
@@ -66,72 +72,120 @@ async def test_build_ftl_gate():
         send_message(proc.stdin, "Shutdown", {})
         await proc.wait()
         os.unlink(ftl_gate)
-        clean_up_ftl_cache()
-        clean_up_tmp()
 
 
+@pytest.mark.parametrize(
+    "message_type,result_type,module_dirs,result_key",
+    [
+        ("Module", "ModuleResult", ["modules"], "stdout"),
+        ("FTLModule", "FTLModuleResult", ["ftl_modules"], "result"),
+    ],
+)
 @pytest.mark.asyncio
-async def test_run_module():
+async def test_run_module(ftl_gate, message_type, result_type, module_dirs, result_key):
     os.chdir(HERE)
-    ftl_gate = build_ftl_gate()
-    proc = await asyncio.create_subprocess_shell(
+    proc = await asyncio.create_subprocess_exec(
         ftl_gate,
         stdin=asyncio.subprocess.PIPE,
         stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
     )
 
     try:
+        # Send both messages before reading so the gate handles them back to back.
+        module = base64.b64encode(read_module(module_dirs, "argtest")).decode()
         send_message(proc.stdin, "Hello", {})
+        send_message(
+            proc.stdin, message_type, dict(module=module, module_name="argtest")
+        )
         message = await read_message(proc.stdout)
         assert message[0] == "Hello"
         assert message[1] == {}
 
-        with open(find_module(["modules"], "argtest"), "rb") as f:
-            module = base64.b64encode(f.read()).decode()
-        send_message(proc.stdin, "Module", dict(module=module, module_name="argtest"))
         message = await read_message(proc.stdout)
         assert message[0] != "GateSystemError", message[1]
-        assert message[0] == "ModuleResult"
+        assert message[0] == result_type
         assert message[1] != {}
-        assert message[1]["stdout"]
+        assert message[1][result_key]
     finally:
         send_message(proc.stdin, "Shutdown", {})
         await proc.wait()
-        os.unlink(ftl_gate)
-        clean_up_ftl_cache()
-        clean_up_tmp()
 
 
 @pytest.mark.asyncio
-async def test_run_ftl_module():
+async def test_run_module_payload(ftl_gate):
     os.chdir(HERE)
-    ftl_gate = build_ftl_gate()
-    proc = await asyncio.create_subprocess_shell(
+    proc = await asyncio.create_subprocess_exec(
         ftl_gate,
         stdin=asyncio.subprocess.PIPE,
         stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
     )
 
     try:
-        send_message(proc.stdin, "Hello", {})
+        with open(find_module(["modules"], "argtest"), "rb") as f:
+            module = f.read()
+        send_message_with_payload(
+            proc.stdin, "Module", dict(module_name="argtest"), module
+        )
         message = await read_message(proc.stdout)
-        assert message[0] == "Hello"
-        assert message[1] == {}
+        assert message[0] != "GateSystemError", message[1]
+        assert message[0] == "ModuleResult"
+        assert message[1]["stdout"]
+    finally:
+        send_message(proc.stdin, "Shutdown", {})
+        await proc.wait()
 
+
+@pytest.mark.asyncio
+async def test_run_ftl_module_payload(ftl_gate):
+    os.chdir(HERE)
+    proc = await asyncio.create_subprocess_exec(
+        ftl_gate,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+    )
+
+    try:
         with open(find_module(["ftl_modules"], "argtest"), "rb") as f:
-            module = base64.b64encode(f.read()).decode()
-        send_message(
-            proc.stdin, "FTLModule", dict(module=module, module_name="argtest")
+            module = f.read()
+        send_message_with_payload(
+            proc.stdin, "FTLModule", dict(module_name="argtest"), module
         )
         message = await read_message(proc.stdout)
         assert message[0] != "GateSystemError", message[1]
         assert message[0] == "FTLModuleResult"
-        assert message[1] != {}
-        assert message[1]["result"]
+        assert message[1]["result"] == {"args": [], "kwargs": {}}
     finally:
         send_message(proc.stdin, "Shutdown", {})
         await proc.wait()
-        os.unlink(ftl_gate)
-        clean_up_tmp()
+
+
+@pytest.mark.asyncio
+async def test_run_ftl_module_payload_from_file(ftl_gate, tmp_path):
+    os.chdir(HERE)
+    # A regular file cannot be connected as a pipe so the gate falls back to
+    # reading stdin directly.
+    frames = tmp_path / "frames"
+    with open(frames, "wb") as f:
+        send_message(f, "Hello", {})
+        send_message_with_payload(
+            f, "FTLModule", dict(module_name="argtest"), read_module(["ftl_modules"], "argtest")
+        )
+        send_message(f, "Shutdown", {})
+    with open(frames, "rb") as f:
+        proc = await asyncio.create_subprocess_exec(
+            ftl_gate,
+            stdin=f,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+        )
+    try:
+        message = await read_message(proc.stdout)
+        assert message[0] == "Hello"
+        message = await read_message(proc.stdout)
+        assert message[0] == "FTLModuleResult", message[1]
+        assert message[1]["result"] == {"args": [], "kwargs": {}}
+    finally:
+        await proc.wait()
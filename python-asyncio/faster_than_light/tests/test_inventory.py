@@ -1,6 +1,6 @@
 
 
-from faster_than_light.inventory import load_inventory
+from faster_than_light.inventory import load_inventory, load_localhost
 import os
 
 HERE = os.path.dirname(os.path.abspath(__file__))
@@ -10,3 +10,31 @@ def test_inventory():
     os.chdir(HERE)
     inventory = load_inventory('inventory.yml')
     assert inventory
+
+
+def test_inventory_cached(tmp_path, monkeypatch):
+    inventory_file = tmp_path / 'inventory.yml'
+    inventory_file.write_text('all:\n  hosts:\n    a:\n')
+    os.utime(inventory_file, ns=(0, 0))
+    inventory = load_inventory(str(inventory_file))
+    # Changes to a loaded inventory do not leak into later loads.
+    inventory['all']['hosts']['c'] = None
+    assert load_inventory(str(inventory_file)) == {'all': {'hosts': {'a': None}}}
+    # A rewrite within the same mtime is seen through the size.
+    inventory_file.write_text('all:\n  hosts:\n    bb:\n')
+    os.utime(inventory_file, ns=(0, 0))
+    assert load_inventory(str(inventory_file)) == {'all': {'hosts': {'bb': None}}}
+    # Relative paths are resolved against the current directory.
+    other = tmp_path / 'other'
+    other.mkdir()
+    (other / 'inventory.yml').write_text('all:\n  hosts:\n    cc:\n')
+    os.utime(other / 'inventory.yml', ns=(0, 0))
+    monkeypatch.chdir(tmp_path)
+    assert load_inventory('inventory.yml') == {'all': {'hosts': {'bb': None}}}
+    monkeypatch.chdir(other)
+    assert load_inventory('inventory.yml') == {'all': {'hosts': {'cc': None}}}
+
+
+def test_load_localhost():
+    os.chdir(HERE)
+    assert load_localhost('/usr/bin/python3') == load_inventory('inventory.yml')
@@ -0,0 +1,112 @@
+
+
+import os
+import sys
+import pytest
+import faster_than_light.ssh
+from faster_than_light.gate import build_ftl_gate
+from faster_than_light.ssh import ConnectionPool, connect_gate, close_gate, backoff, get_connection_pool, open_gate, clean_up_gates
+from faster_than_light.exceptions import GateStartFailed
+from faster_than_light.util import clean_up_tmp
+
+
+def test_backoff():
+    for attempt in range(10):
+        assert 0 <= backoff(attempt) <= min(30, 0.5 * 2 ** attempt)
+    assert backoff(100, cap=1) <= 1
+
+
+@pytest.mark.asyncio
+async def test_connection_pool():
+    pool = ConnectionPool(max_gates=2)
+    conn1 = await pool.acquire('localhost')
+    conn2 = await pool.acquire('localhost')
+    conn3 = await pool.acquire('localhost')
+    assert conn1 is conn2
+    assert conn1 is not conn3
+    pool.release(conn1)
+    assert not conn1.is_closed()
+    pool.release(conn2)
+    await conn1.wait_closed()
+    assert await pool.acquire('localhost') is conn3
+    pool.release(conn3)
+    pool.release(conn3)
+    await conn3.wait_closed()
+    assert not pool.leases
+
+
+@pytest.mark.asyncio
+async def test_connect_gate_reuses_deployment():
+    gate = build_ftl_gate()
+    gate1 = await connect_gate(gate, 'localhost', None, sys.executable)
+    gate2 = await connect_gate(gate, 'localhost', None, sys.executable)
+    try:
+        assert gate1.conn is gate2.conn
+        assert gate1.temp_dir == gate2.temp_dir
+        assert gate1.gate_process is not gate2.gate_process
+        pool = get_connection_pool()
+        assert await pool.sftp_client(gate1.conn) is await pool.sftp_client(gate2.conn)
+    finally:
+        await close_gate(*gate1)
+        await close_gate(*gate2)
+
+
+@pytest.mark.asyncio
+async def test_open_gate_timeout(monkeypatch):
+    monkeypatch.setattr(faster_than_light.ssh, 'GATE_START_TIMEOUT', 0.5)
+    pool = ConnectionPool()
+    conn = await pool.acquire('localhost')
+    try:
+        await conn.run('mkdir -p /tmp/ftl-test && printf "#!/bin/sh\\necho started >&2\\nsleep 60\\n" > /tmp/ftl-test/ftl_gate.pyz && chmod 700 /tmp/ftl-test/ftl_gate.pyz', check=True)
+        with pytest.raises(GateStartFailed, match='started'):
+            await open_gate(conn, '/tmp/ftl-test')
+    finally:
+        pool.release(conn)
+
+
+@pytest.mark.asyncio
+async def test_close_gate_removes_upload():
+    gate = build_ftl_gate()
+    gate1 = await connect_gate(gate, 'localhost', None, sys.executable)
+    gate2 = await connect_gate(gate, 'localhost', None, sys.executable)
+    assert gate1.temp_dir == gate2.temp_dir
+    await close_gate(*gate1)
+    assert os.path.exists(gate2.temp_dir)
+    await close_gate(*gate2)
+    assert not os.path.exists(gate2.temp_dir)
+    pool = get_connection_pool()
+    assert not pool.deployments
+    assert not pool.deployment_leases
+
+
+@pytest.mark.asyncio
+async def test_connect_gate_replaces_removed_upload():
+    gate = build_ftl_gate()
+    gate1 = await connect_gate(gate, 'localhost', None, sys.executable)
+    try:
+        clean_up_tmp()
+        gate2 = await connect_gate(gate, 'localhost', None, sys.executable)
+        try:
+            assert gate2.temp_dir != gate1.temp_dir
+            assert os.path.exists(gate2.temp_dir)
+        finally:
+            await close_gate(*gate2)
+    finally:
+        await close_gate(*gate1)
+    assert not get_connection_pool().deployment_leases
+
+
+@pytest.mark.asyncio
+async def test_clean_up_gates(monkeypatch):
+    gate = build_ftl_gate()
+    gate1 = await connect_gate(gate, 'localhost', None, sys.executable)
+    cache = {('localhost', None, sys.executable): gate1}
+    assert os.path.exists(gate1.temp_dir)
+    pool = get_connection_pool()
+    # The gates are removed over the connections they already hold.
+    monkeypatch.setattr(pool, 'acquire', None)
+    await clean_up_gates(cache)
+    assert not cache
+    assert not os.path.exists(gate1.temp_dir)
+    assert not pool.leases
+    assert not pool.deployments
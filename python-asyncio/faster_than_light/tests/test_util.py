@@ -1,9 +1,13 @@
 
 
 import os
+import sys
+import math
+import asyncio
 import pytest
-from faster_than_light.util import find_module, read_module
+from faster_than_light.util import find_module, read_module, read_module_bytes, classify_module, list_module_dir, clear_module_cache, chunk, run_fast_loop, process_module_result
 from faster_than_light.exceptions import ModuleNotFound
+from faster_than_light.message import GateMessage
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 
@@ -21,3 +25,96 @@ def test_read_module():
     assert read_module(['modules'], 'argtest') is not None
     with pytest.raises(ModuleNotFound):
         assert read_module(['modules'], 'ASDFAD_not_found_ASDFADF') is not None
+
+
+def test_read_module_bytes(tmp_path):
+    module = tmp_path / 'module.py'
+    module.write_bytes(b'one')
+    assert read_module_bytes(str(module)) == b'one'
+    module.write_bytes(b'two')
+    os.utime(module, ns=(0, 0))
+    assert read_module_bytes(str(module)) == b'two'
+
+
+def test_find_module_cached(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert find_module(['.'], 'late') is None
+    (tmp_path / 'late.py').write_text('')
+    assert find_module(['.'], 'late') == './late.py'
+    (tmp_path / 'late.py').unlink()
+    assert find_module(['.'], 'late') is None
+    clear_module_cache()
+    assert find_module(['.'], 'late') is None
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+    (tmp_path / 'b' / 'late.py').write_text('')
+    assert find_module(['a', 'b'], 'late') == 'b/late.py'
+    (tmp_path / 'a' / 'late.py').write_text('')
+    assert find_module(['a', 'b'], 'late') == 'a/late.py'
+
+
+def test_classify_module(tmp_path):
+    os.chdir(HERE)
+    assert classify_module('modules/argtest.py') == (False, False, False)
+    assert classify_module('modules/new_style.py') == (False, True, False)
+    assert classify_module('modules/want_json.py') == (False, False, True)
+    binary = tmp_path / 'binary'
+    binary.write_bytes(b'\x7fELF\xff\xfe')
+    assert classify_module(str(binary)) == (True, False, False)
+
+
+def test_list_module_dir(tmp_path):
+    assert list_module_dir(str(tmp_path / 'missing')) == frozenset()
+    (tmp_path / 'a.py').write_text('')
+    assert list_module_dir(str(tmp_path)) == {'a.py'}
+    (tmp_path / 'b').write_text('')
+    os.utime(tmp_path, ns=(0, 0))
+    assert list_module_dir(str(tmp_path)) == {'a.py', 'b'}
+
+
+def test_chunk():
+    assert list(chunk([1, 2, 3, 4, 5], 2)) == [[1, 2], [3, 4], [5]]
+    assert list(chunk(iter(range(4)), 2)) == [[0, 1], [2, 3]]
+    assert list(chunk([], 2)) == []
+
+
+def test_find_module_with_extension():
+    os.chdir(HERE)
+    assert find_module(['modules'], 'argtest.py') == find_module(['modules'], 'argtest')
+
+
+async def answer():
+    return 42
+
+
+def test_run_fast_loop_without_uvloop(monkeypatch):
+    monkeypatch.setitem(sys.modules, 'uvloop', None)
+    assert run_fast_loop(answer()) == 42
+
+
+class FakeUvloop:
+
+    def __init__(self):
+        self.loops = []
+
+    def new_event_loop(self):
+        loop = asyncio.new_event_loop()
+        self.loops.append(loop)
+        return loop
+
+    def run(self, main):
+        with asyncio.Runner(loop_factory=self.new_event_loop) as runner:
+            return runner.run(main)
+
+
+@pytest.mark.skipif(sys.version_info < (3, 11), reason="requires asyncio.Runner")
+def test_run_fast_loop_with_uvloop(monkeypatch):
+    fake = FakeUvloop()
+    monkeypatch.setitem(sys.modules, 'uvloop', fake)
+    assert run_fast_loop(answer()) == 42
+    assert len(fake.loops) == 1
+
+
+def test_process_module_result_nan():
+    result = process_module_result(GateMessage('ModuleResult', dict(stdout='{"value": NaN}', stderr='')))
+    assert math.isnan(result['value'])